@@ -1,20 +1,19 @@
 import asyncio
-import collections
+import concurrent.futures
 import logging
 from datetime import datetime
 import streams_util
 
 async def start_client() -> None:
-    reader, writer = await asyncio.open_connection("192.168.99.108", 12345)
-    buffer = collections.deque[str]()
+    reader, writer = await streams_util.open_connection("192.168.99.108", 12345)
+    input_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
-    
     success = await streams_util.writeline("Server", writer, "HELLO")
     if not success:
         logging.info("Write was not successful")
     else:
         while True:
-            message = await streams_util.readline("Server", reader, buffer, log_debug_prefix=["PING"])
+            message = await streams_util.readline("Server", reader, log_debug_prefix=["PING"])
             expected_response, message = parse_server_message(message)
 
             if message is None:
@@ -31,7 +30,7 @@ async def start_client() -> None:
             print(message)
 
             if expected_response:
-                response = input(" > ")
+                response = await asyncio.get_running_loop().run_in_executor(input_executor, input, " > ")
                 success = await streams_util.writeline("Server", writer, response)
                 if not success:
                     logging.info("Write was not successful")
@@ -39,6 +38,7 @@ async def start_client() -> None:
 
     logging.info("Closing the connection")
     writer.close()
+    input_executor.shutdown(wait=False)
     print("The connection has been closed")
 
 def parse_server_message(message: str) -> tuple[bool, str]:
@@ -7,7 +7,15 @@ from server import Server, Connection
 from game import Game, GameOverError, PlayerDisconnectedError
 from visualizer import Visualizer
 import random
-import os.path
+from typing import Any, Coroutine
+import os
+
+VISUALIZER_FILE_BUFFER_SIZE = 65536
+VISUALIZER_BATCH_SIZE = 64
+VISUALIZE_QUEUE_DROP_SIZE = 1024
+
+class TaskFinished(Exception):
+    pass
 
 class GameManager:
     def __init__(self, server: Server, game_type: type[Game], visualizer_type: type[Visualizer]) -> None:
@@ -15,24 +23,41 @@ class GameManager:
         self.game_type = game_type
         self.game: Game = None
         self.players: list[Connection] = []
+        self.player_placeholders: list[tuple[str, str]] = []
         self.visualizer_type = visualizer_type
         self.visualizer: Visualizer = None
         self.visualize_queue: collections.deque[str] = collections.deque()
+        self.dropped_frames = 0
         self.game_frame_queue: collections.deque[str] = collections.deque()
+        self.visualize_event = asyncio.Event()
         self.visualizer_file_name: str = ""
+        self.visualizer_file_descriptor: int = None
+        self.visualizer_file_buffer = bytearray()
 
         self.start_cooldown = 0
 
+        self.connections_dirty = True
+        self.active_connections: list[Connection] = []
+        self.active_names: list[str] = []
+        self.active_name_string = ""
+
     def reset_start_cooldown(self) -> None:
         self.start_cooldown = self.game.start_cooldown()
 
     async def wait_for_connections(self) -> list[Connection]:
+        waiting_frame = ""
         while True:
             self.handle_connection_queues()
 
-            active_connections = self.server.connections[:]
-            names = [c.name for c in active_connections]
-            name_string = " ".join(names)
+            if self.connections_dirty:
+                self.active_connections = list(self.server.connections.values())
+                self.active_names = [c.name for c in self.active_connections]
+                self.active_name_string = " ".join(self.active_names)
+                self.connections_dirty = False
+
+            active_connections = self.active_connections
+            names = self.active_names
+            name_string = self.active_name_string
             logging.debug("GAME_MANAGER there are %d/%d active connections: %r" % (
                 len(active_connections), 
                 self.game.min_connections(), 
@@ -41,10 +66,14 @@ class GameManager:
             
             if len(active_connections) < self.game.min_connections():
                 self.reset_start_cooldown()
-                logging.debug("GAME_MANAGER send waiting frame")
-                self.visualize("WAITING %d %s" % (self.game.min_connections(), name_string), False, False)
 
-                await asyncio.sleep(1)
+                previous_waiting_frame = waiting_frame
+                waiting_frame = "WAITING %d %s" % (self.game.min_connections(), name_string)
+                if waiting_frame != previous_waiting_frame:
+                    logging.debug("GAME_MANAGER send waiting frame")
+                    self.visualize(waiting_frame, False, False)
+
+                await self.wait_for_connection_change()
                 continue
 
             if self.start_cooldown > 0:
@@ -53,8 +82,9 @@ class GameManager:
                 self.visualize("START_IN %d %s" % (self.start_cooldown, name_string), False, False)
                 
                 self.start_cooldown -= 1
+                waiting_frame = ""
 
-                await asyncio.sleep(1)
+                await self.wait_for_connection_change()
                 continue
 
             logging.debug("GAME_MANAGER send starting frame")
@@ -65,57 +95,55 @@ class GameManager:
             if self.game.max_connections() > 0 and len(active_connections) > self.game.max_connections():
                 active_connections = random.sample(active_connections, self.game.max_connections())
             else:
+                active_connections = active_connections[:]
                 random.shuffle(active_connections)
 
             return active_connections
 
     async def start(self) -> None:
-        gm_tasks: list[asyncio.Task] = []
+        try:
+            logging.info("GAME_MANAGER initializing game")
+            self.game = self.game_type(self.game_frame_queue)
+            self.game_name = self.game.get_game_name()
 
-        logging.info("GAME_MANAGER starting server")
-        gm_tasks.append(asyncio.create_task(self.server.start_server()))
+            logging.debug("GAME_MANAGER create visualizer file")
+            self.visualizer_file_name = self.create_visualizer_file()
 
-        logging.info("GAME_MANAGER initializing game")
-        self.game = self.game_type(self.game_frame_queue)
-        self.game_name = self.game.get_game_name()
-    
-        logging.debug("GAME_MANAGER create visualizer file")
-        self.visualizer_file_name = self.create_visualizer_file()
+            logging.info("GAME_MANAGER initializing visualizer")
+            self.visualizer = self.visualizer_type(self.game_name)
+            await self.visualizer.setup_visualizer()
 
-        logging.info("GAME_MANAGER initializing visualizer")
-        self.visualizer = self.visualizer_type(self.game_name)
-        await self.visualizer.setup_visualizer()
-        gm_tasks.append(asyncio.create_task(self.visualizer_loop()))
+            async with asyncio.TaskGroup() as task_group:
+                logging.info("GAME_MANAGER starting server")
+                task_group.create_task(self.run_task("server", self.server.start_server()))
 
-        logging.info("GAME_MANAGER starting game loop")
-        gm_tasks.append(asyncio.create_task(self.game_loop()))
+                logging.info("GAME_MANAGER starting visualizer loop")
+                task_group.create_task(self.run_task("visualizer loop", self.visualizer_loop()))
 
-        done, pending = await asyncio.wait(gm_tasks, return_when=asyncio.FIRST_COMPLETED)
+                logging.info("GAME_MANAGER starting game loop")
+                task_group.create_task(self.run_task("game loop", self.game_loop()))
 
-        logging.info("GAME_MANAGER check for task errors")
-        for done_task in done:
-            try:
-                task_result = done_task.result()
-                logging.info("GAME_MANAGER task finished successfully %s" % done_task)
-            except Exception as ex:
-                logging.error("GAME_MANAGER ERROR task error", exc_info=ex)
+        except* TaskFinished as eg:
+            for ex in eg.exceptions:
+                logging.info("GAME_MANAGER task finished successfully %s" % ex)
 
-        for pending_task in pending:
-            logging.info("GAME_MANAGER task pending %s - cancel" % pending_task)
-            pending_task.cancel()
+        except* Exception as eg:
+            for ex in eg.exceptions:
+                logging.error("GAME_MANAGER ERROR task error", exc_info=ex)
 
-        if pending:
-            logging.info("GAME_MANAGER wait for pending tasks to fully shut down")
-            try:
-                await asyncio.wait_for(asyncio.gather(*pending), 10)
-                logging.info("GAME_MANAGER pending tasks shut down successfully")
-            except Exception as ex:
-                logging.error("GAME_MANAGER ERROR pending tasks could not be shut down", exc_info=ex)
-        else:
-            logging.info("GAME_MANAGER there are no pending tasks")
+        logging.debug("GAME_MANAGER close visualizer file")
+        self.close_visualizer_file()
 
         logging.info("GAME_MANAGER stop")
 
+    async def run_task(self, name: str, coroutine: Coroutine[Any, Any, None]) -> None:
+        await coroutine
+        if asyncio.current_task().cancelling():
+            logging.info("GAME_MANAGER task cancelled %s" % name)
+            return
+
+        raise TaskFinished(name)
+
     async def game_loop(self) -> None:
         try:
             while True:
@@ -123,12 +151,14 @@ class GameManager:
                 self.players = await self.wait_for_connections()
                 if self.players is None:
                     raise RuntimeError("Connections returned None")
+                self.player_placeholders = [("@p%d!" % index, conn.name) for index, conn in enumerate(self.players)]
                 
                 logging.info("GAME_MANAGER play game")
                 await self.play_game()
 
                 self.game = None
                 self.players = []
+                self.player_placeholders = []
 
                 logging.info("GAME_MANAGER initializing new game")
                 if self.game_frame_queue:
@@ -145,14 +175,24 @@ class GameManager:
         except asyncio.CancelledError as ex:
             logging.warning("GAME_MANAGER ERROR game loop cancelled", exc_info=ex)
 
+    async def wait_for_connection_change(self) -> None:
+        try:
+            await asyncio.wait_for(self.server.connection_event.wait(), 1)
+        except TimeoutError:
+            pass
+
     def handle_connection_queues(self) -> None:
+        self.server.connection_event.clear()
+
         while self.server.connection_queue:
             connection = self.server.connection_queue.popleft()
             self.reset_start_cooldown()
+            self.connections_dirty = True
 
         while self.server.disconnection_queue:
             connection = self.server.disconnection_queue.popleft()
             self.reset_start_cooldown()
+            self.connections_dirty = True
 
             if self.game is not None and connection in self.players:
                 raise PlayerDisconnectedError("Player %s disconnected during game" % connection.name)
@@ -165,28 +205,35 @@ class GameManager:
             await self.game.setup_game()
             self.handle_game_frame_queue()
 
+            prepare_round = self.game.prepare_round
+            handle_player_output = self.game.handle_player_output
+            update_game = self.game.update_game
+            get_player_outputs = self.get_player_outputs
+            handle_game_frame_queue = self.handle_game_frame_queue
+            visualize_round = self.visualize_round
+
             round = -1
             while True:
                 round += 1
                 logging.info("GAME_MANAGER start round %d" % round)
 
                 logging.debug("GAME_MANAGER prepare round %d" % round)
-                await self.game.prepare_round(round)
-                self.handle_game_frame_queue()
+                await prepare_round(round)
+                handle_game_frame_queue()
 
                 logging.debug("GAME_MANAGER get player outputs %d" % round)
-                player_outputs = await self.get_player_outputs(round)
+                player_outputs = await get_player_outputs(round)
 
                 logging.debug("GAME_MANAGER handle player outputs %d" % round)
                 for index, output in player_outputs:
-                    await self.game.handle_player_output(round, index, output)
-                    self.handle_game_frame_queue()
+                    await handle_player_output(round, index, output)
+                    handle_game_frame_queue()
 
                 logging.debug("GAME_MANAGER update game %d" % round)
-                await self.game.update_game(round)
+                await update_game(round)
 
                 logging.debug("GAME_MANAGER get visualizer data %d" % round)
-                await self.visualize_round()
+                await visualize_round()
 
         except PlayerDisconnectedError as ex:
             logging.warning("GAME_MANAGER PlayerDisconnectedError", exc_info=ex)
@@ -199,28 +246,55 @@ class GameManager:
 
         await self.game.on_game_over()
         self.handle_game_frame_queue()
+        self.flush_visualizer_file()
 
     def create_visualizer_file(self) -> str:
+        self.close_visualizer_file()
+
         today = datetime.now()
         date_string = today.strftime("%Y-%m-%d %H:%M:%S")
         base_name = "games/game_%s_%s" % (self.game.get_game_name(), date_string)
         
         duplicate_index = 0
         file_name = "%s.txt" % base_name
-        while os.path.isfile(file_name):
-            duplicate_index += 1
-            file_name = "%s_%d.txt" % (base_name, duplicate_index)
+        while True:
+            try:
+                file_descriptor = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+                break
+            except FileExistsError:
+                duplicate_index += 1
+                file_name = "%s_%d.txt" % (base_name, duplicate_index)
 
         visualize_file_name = file_name
-        with open(visualize_file_name, "w"):
-            pass
+        self.visualizer_file_descriptor = file_descriptor
+        self.visualizer_file_buffer.clear()
 
         return visualize_file_name
 
+    def flush_visualizer_file(self) -> None:
+        if self.visualizer_file_descriptor is None:
+            return
+
+        buffer = self.visualizer_file_buffer
+        while buffer:
+            written = os.write(self.visualizer_file_descriptor, buffer)
+            del buffer[:written]
+
+    def close_visualizer_file(self) -> None:
+        if self.visualizer_file_descriptor is None:
+            return
+
+        self.flush_visualizer_file()
+        os.close(self.visualizer_file_descriptor)
+        self.visualizer_file_descriptor = None
+
     def handle_game_frame_queue(self) -> None:
-        while self.game_frame_queue:
-            game_frame = self.game_frame_queue.popleft()
-            self.visualize(game_frame, False)
+        game_frame_queue = self.game_frame_queue
+        popleft = game_frame_queue.popleft
+        visualize = self.visualize
+        while game_frame_queue:
+            game_frame = popleft()
+            visualize(game_frame, False)
 
     async def visualize_round(self) -> None:
         self.handle_game_frame_queue()
@@ -230,64 +304,75 @@ class GameManager:
             self.visualize(visualizer_data, True)
 
     def visualize(self, data: str, keyframe: bool, write_to_file: bool = True) -> None:
-        for index, conn in enumerate(self.players):
-            data = data.replace("@p%d!" % index, conn.name)
-        
-        if keyframe:
-            data = "KEYFRAME " + data
-        else:
-            data = "FRAME " + data
+        if "@p" in data:
+            for placeholder, name in self.player_placeholders:
+                data = data.replace(placeholder, name)
 
-        self.visualize_queue.append(data)
+        data = ("KEYFRAME " if keyframe else "FRAME ") + data
+
+        if keyframe or len(self.visualize_queue) < VISUALIZE_QUEUE_DROP_SIZE:
+            self.visualize_queue.append(data)
+            self.visualize_event.set()
+        else:
+            self.dropped_frames += 1
+            logging.debug("GAME_MANAGER visualize queue is full, dropped frame %d" % self.dropped_frames)
 
         if write_to_file:
-            with open(self.visualizer_file_name, "a") as file:
-                file.write(data)
-                file.write("\n")
+            self.visualizer_file_buffer += data.encode()
+            self.visualizer_file_buffer += b"\n"
+
+            if keyframe or len(self.visualizer_file_buffer) >= VISUALIZER_FILE_BUFFER_SIZE:
+                self.flush_visualizer_file()
 
     async def visualizer_loop(self) -> None:
         try:
+            visualize_queue = self.visualize_queue
+            popleft = visualize_queue.popleft
+
             delay = 0
             while True:
                 if self.visualizer is None:
                     logging.info("GAME_MANAGER visualizer is None, exit loop")
                     return
                 
-                await self.visualizer.process_events()
+                self.visualizer.process_events()
                 if not self.visualizer.running:
                     logging.info("GAME_MANAGER visualizer is no longer running, exit loop")
                     self.visualizer = None
                     return
 
-                dt = self.visualizer.clock.tick(self.visualizer.get_fps())
+                dt = await self.visualizer.wait_next_frame()
                 delay -= dt
                 if delay < 0:
                     delay = 0
-                
+
                 if delay:
-                    await asyncio.sleep(0)
                     continue
 
-                if not self.visualize_queue:
-                    await asyncio.sleep(0)
+                if not visualize_queue:
+                    self.flush_visualizer_file()
+                    self.visualize_event.clear()
+                    try:
+                        await asyncio.wait_for(self.visualize_event.wait(), 1 / self.visualizer.get_fps())
+                    except TimeoutError:
+                        pass
                     continue
 
                 skipped = 0
                 data = ""
-                while self.visualize_queue and delay == 0:
+                while visualize_queue and delay == 0 and skipped < VISUALIZER_BATCH_SIZE:
                     if skipped:
                         logging.info("GAME_MANAGER visualizer skipped frame %d - %s" % (skipped, data))
                     
-                    data = self.visualize_queue.popleft()
-
-                    keyframe = False
-                    if data.startswith("KEYFRAME "):
-                        keyframe = True
-                        data = data[9:]
-                    elif data.startswith("FRAME "):
-                        data = data[6:]
-                    else:
-                        raise RuntimeError("Unhandled visualize message prefix: %s" % data)
+                    data = popleft()
+
+                    frame_data = data.removeprefix("KEYFRAME ")
+                    keyframe = frame_data is not data
+                    if not keyframe:
+                        frame_data = data.removeprefix("FRAME ")
+                        if frame_data is data:
+                            raise RuntimeError("Unhandled visualize message prefix: %s" % data)
+                    data = frame_data
                         
                     delay = await self.visualizer.visualize(data, keyframe)
                     skipped += 1
@@ -299,8 +384,7 @@ class GameManager:
 
     async def get_player_outputs(self, round: int) -> list[tuple[int, str]]:
         response_tasks: list[asyncio.Task] = []
-        response_indicies: list[int] = []
-        task_map: dict[asyncio.Task, int] = {}
+        task_map: dict[asyncio.Task, tuple[int, int]] = {}
 
         for index, connection in enumerate(self.players):
             round_input = await self.game.get_player_input(round, index)
@@ -313,35 +397,33 @@ class GameManager:
                 self.server.get_response(connection, round_input)
             )
 
+            task_map[response_task] = (len(response_tasks), index)
             response_tasks.append(response_task)
-            response_indicies.append(index)
-            task_map[response_task] = index
 
         if not response_tasks:
             raise RuntimeError("No player inputs were returned")
 
-        responses: list[str] = [None for _ in response_tasks]
+        response_queue: asyncio.Queue[asyncio.Task] = asyncio.Queue()
+        for response_task in response_tasks:
+            response_task.add_done_callback(response_queue.put_nowait)
+
+        player_outputs: list[tuple[int, str]] = [None for _ in response_tasks]
         responded = 0
         expected = len(response_tasks)
-        while response_tasks:
-            done, response_tasks = await asyncio.wait(response_tasks, return_when=asyncio.FIRST_COMPLETED)
-
-            for response in done:
-                responded += 1
+        while responded < expected:
+            response = await response_queue.get()
+            responded += 1
 
-                index = task_map[response]
-                result: str = response.result()
-                responses[index] = result
+            position, index = task_map[response]
+            result: str = response.result()
+            player_outputs[position] = (index, result)
 
-                logging.debug("GAME_MANAGER response from %d on round %d: %r" % (index, round, result))
-                await self.game.on_player_output(round, index, result)
-                self.handle_game_frame_queue()
-
-        if responded != expected:
-            raise RuntimeError("Did not get all responses on round %d. Expected %d. Recieved %d" % (round, expected, responded))
+            logging.debug("GAME_MANAGER response from %d on round %d: %r" % (index, round, result))
+            await self.game.on_player_output(round, index, result)
+            self.handle_game_frame_queue()
 
         self.handle_connection_queues()
-        return list(zip(response_indicies, responses))
+        return player_outputs
 
 def main() -> None:
     server = Server()
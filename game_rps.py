@@ -1,12 +1,25 @@
 import asyncio
+import collections
 import json
 import logging
 from game import Game, GameOverError
 from visualizer import Visualizer
 import logging
 import pygame
+from typing import Callable
 # import pprint
 
+try:
+    import orjson
+
+    def json_dumps(data: dict) -> str:
+        return orjson.dumps(data).decode()
+
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
 class RockPaperScissorsGame(Game):
     def get_game_name(self) -> str:
         return "Rock Paper Scissors"
@@ -16,9 +29,9 @@ class RockPaperScissorsGame(Game):
             raise RuntimeError("Unexpected player count: %d" % self.player_count)
 
         self.valid_moves = {
-            "Rock": "Scissors",
-            "Paper": "Rock",
-            "Scissors": "Paper"
+            "Rock": 0,
+            "Paper": 1,
+            "Scissors": 2
         }
 
         self.scores: list[int] = [0 for _ in range(self.player_count)]
@@ -26,15 +39,34 @@ class RockPaperScissorsGame(Game):
 
         self.waiting: list[bool] = [True for _ in range(self.player_count)]
         self.moves: list[str] = [None for _ in range(self.player_count)]
+        self.move_codes: list[int] = [-1 for _ in range(self.player_count)]
         self.revealed: bool = False
 
         self.message: str = ""
         self.delay: int = 0
 
+        self.round_winner: int = -1
+        self.game_winner: int = -1
+
+        self.visualizer_data = {
+            "message": self.message,
+            "names": self.player_names,
+            "scores": self.scores,
+            "winning_score": self.winning_score,
+            "waiting": self.waiting,
+            "revealed": self.revealed,
+            "moves": self.moves,
+            "round_winner": -1,
+            "game_winner": -1,
+            "delay": self.delay
+        }
+
     async def prepare_round(self, round: int) -> str:
         self.waiting = [True for _ in self.moves]
         self.moves = [None for _ in self.moves]
+        self.move_codes = [-1 for _ in self.move_codes]
         self.revealed = False
+        self.round_winner = -1
 
         self.visualize_frame("Waiting for responses", 0)
 
@@ -50,22 +82,24 @@ class RockPaperScissorsGame(Game):
 
     async def handle_player_output(self, round: int, player_index: int, player_output: str) -> None:
         self.moves[player_index] = player_output
+        self.move_codes[player_index] = self.valid_moves.get(player_output, -1)
 
     async def update_game(self, round: int) -> None:
         self.revealed = True
+        self.round_winner = self.get_round_winner()
         self.visualize_frame("Revealing choices", 2000)
 
-        if self.moves[0] not in self.valid_moves and self.moves[1] not in self.valid_moves:
+        if self.move_codes[0] < 0 and self.move_codes[1] < 0:
             self.visualize_frame("@p0! and @p1! both had invalid moves!", 2000)
             raise GameOverError("Both players had an invalid move: %s, %s" % (*self.moves,))
-        elif self.moves[0] not in self.valid_moves:
+        elif self.move_codes[0] < 0:
             self.visualize_frame("@p0! had an invalid move!", 2000)
             raise GameOverError("Player %d had an invalid move: %s" % (0, self.moves[0]))
-        elif self.moves[1] not in self.valid_moves:
+        elif self.move_codes[1] < 0:
             self.visualize_frame("@p1! had an invalid move!", 2000)
             raise GameOverError("Player %d had an invalid move: %s" % (1, self.moves[1]))
 
-        round_winner = self.get_round_winner()
+        round_winner = self.round_winner
         result = ""
         if round_winner == -1:
             logging.info("GAME both players picked %s. This round is a draw!" % self.moves[0])
@@ -76,11 +110,12 @@ class RockPaperScissorsGame(Game):
 
             logging.info("GAME %s beats %s! Player %d wins this round!" % (self.moves[index], self.moves[other_index], index))
             result = "@p%d!'s %s beats @p%d!'s %s!" % (index, self.moves[index], other_index, self.moves[other_index])
-            self.scores[index] += 1            
+            self.scores[index] += 1
+            self.game_winner = self.get_game_winner()
         
         self.visualize_frame(result, 4000)
 
-        game_winner = self.get_game_winner()
+        game_winner = self.game_winner
         if game_winner > -1:
             self.visualize_frame("@p%d! wins!" % game_winner, 4000)
             raise GameOverError("Player %d wins" % game_winner)
@@ -89,20 +124,16 @@ class RockPaperScissorsGame(Game):
         self.visualize_frame("Game over.", 2000)
 
     def get_visualizer_data(self) -> str:
-        data = {
-            "message": self.message,
-            "names": self.player_names,
-            "scores": self.scores,
-            "winning_score": self.winning_score,
-            "waiting": self.waiting,
-            "revealed": self.revealed,
-            "moves": self.moves,
-            "round_winner": self.get_round_winner(),
-            "game_winner": self.get_game_winner(),
-            "delay": self.delay
-        }
+        data = self.visualizer_data
+        data["message"] = self.message
+        data["waiting"] = self.waiting
+        data["revealed"] = self.revealed
+        data["moves"] = self.moves
+        data["round_winner"] = self.round_winner
+        data["game_winner"] = self.game_winner
+        data["delay"] = self.delay
 
-        return json.dumps(data)
+        return json_dumps(data)
 
     def min_connections(self) -> int:
         return 2
@@ -114,22 +145,12 @@ class RockPaperScissorsGame(Game):
         return 1
 
     def get_round_winner(self) -> int:
-        if any(move is None for move in self.moves):
-            return -1
-
-        if any(move not in self.valid_moves for move in self.moves):
-            return -1
-        
-        if self.moves[0] == self.moves[1]:
+        move_0, move_1 = self.move_codes
+        if move_0 < 0 or move_1 < 0 or move_0 == move_1:
             return -1
 
-        for index in range(2):
-            other_index = 1 - index
-
-            if self.valid_moves[self.moves[index]] == self.moves[other_index]:
-                return index
-
-        raise RuntimeError("Could not determine round winner. Moves: %s" % self.moves)
+        # Each move beats the one before it: Paper beats Rock, Scissors beats Paper, Rock beats Scissors
+        return 0 if (move_0 - move_1) % 3 == 1 else 1
 
     def get_game_winner(self) -> int:
         for index in range(2):
@@ -148,82 +169,66 @@ class RockPaperScissorsGame(Game):
 class RockPaperScissorsVisualizer(Visualizer):
     async def setup_visualizer(self) -> None:
         self.font = pygame.font.SysFont("arial", 20)
+        self.text_cache: collections.OrderedDict[str, pygame.Surface] = collections.OrderedDict()
+        self.text_cache_size = 256
 
-    async def visualize(self, data: str, keyframe: bool) -> int:
-        self.surface.fill((255, 255, 255))
+        self.prefix_handlers: dict[str, Callable[[list[str], int, int], None]] = {
+            "WAITING": self.visualize_waiting,
+            "START_IN": self.visualize_start_in,
+            "STARTING": self.visualize_starting
+        }
 
         center_x = self.surface.get_width() // 2
         center_y = self.surface.get_height() // 2
 
-        if data.startswith("WAITING"):
-            parameters = data.split()
-            required = int(parameters[1])
-            names = parameters[2:]
-
-            self.draw_text(self.game_name, center_x, center_y - 25)
-            self.draw_text("Waiting to start...", center_x, center_y + 25)
-            self.draw_text("%d/%d players connected" % (len(names), required), center_x, center_y + 50)
-            self.draw_text("[%s]" % ", ".join(names), center_x, center_y + 75)
-
-            pygame.display.flip()
-            return 0
+        frame_width = 150
+        frame_height = 245
+        frame_padding = 80
+        frame_offset_y = 0
 
-        if data.startswith("START_IN"):
-            parameters = data.split()
-            countdown = int(parameters[1])
-            names = parameters[2:]
+        self.frame_rects: list[pygame.Rect] = []
+        for index in range(2):
+            frame_rect = pygame.rect.Rect(0, 0, frame_width, frame_height)
+            frame_rect.center = (center_x, center_y)
+            offset_x = (index * 2 - 1) * (frame_width + frame_padding) / 2
+            frame_rect.x += offset_x
+            frame_rect.y += frame_offset_y
+            self.frame_rects.append(frame_rect)
 
-            self.draw_text(self.game_name, center_x, center_y - 25)
-            self.draw_text("Starting in %d..." % countdown, center_x, center_y + 25)
-            self.draw_text("[%s]" % ", ".join(names), center_x, center_y + 50)
+        self.background_colors: dict[tuple[int, int, int], tuple[int, int, int]] = {}
+        for game_winner in range(-1, 2):
+            for round_winner in range(-1, 2):
+                for index in range(2):
+                    key = (game_winner, round_winner, index)
+                    self.background_colors[key] = self.get_background_color(game_winner, round_winner, index)
 
-            pygame.display.flip()
-            return 0
+    async def visualize(self, data: str, keyframe: bool) -> int:
+        self.surface.fill((255, 255, 255))
 
-        if data.startswith("STARTING"):
-            parameters = data.split()
-            names = parameters[1:]
+        center_x = self.surface.get_width() // 2
+        center_y = self.surface.get_height() // 2
 
-            self.draw_text(self.game_name, center_x, center_y - 25)
-            self.draw_text("Starting", center_x, center_y + 25)
-            self.draw_text("[%s]" % ", ".join(names), center_x, center_y + 50)
+        prefix, _, parameters = data.partition(" ")
+        prefix_handler = self.prefix_handlers.get(prefix)
+        if prefix_handler is not None:
+            prefix_handler(parameters.split(), center_x, center_y)
 
-            pygame.display.flip()
+            self.flush()
             return 0
-        
-        data = json.loads(data)
+
+        data = json_loads(data)
 
         self.draw_text(self.game_name, center_x, 30)
         self.draw_text("%d - %d" % (data["scores"][0], data["scores"][1]), center_x, 55)
 
         frame_offset_y = 0
         for index in range(2):
-            frame_width = 150
-            frame_height = 245
-            frame_padding = 80
-
-            frame_rect = pygame.rect.Rect(0, 0, frame_width, frame_height)
-            frame_rect.center = (center_x, center_y)
-            offset_x = (index * 2 - 1) * (frame_width + frame_padding) / 2
-            frame_rect.x += offset_x
-            frame_rect.y += frame_offset_y
-
-            
-
-            if data["game_winner"] == -1:
-                if data["round_winner"] == -1:
-                    background_color = (200, 200, 200)
-                elif data["round_winner"] == index:
-                    background_color = (200, 255, 200)
-                else:
-                    background_color = (255, 200, 200)
-            elif data["game_winner"] == index:
-                background_color = (200, 255, 200)
-            else:
-                background_color = (200, 200, 200)
+            frame_rect = self.frame_rects[index]
+            background_color = self.background_colors[(data["game_winner"], data["round_winner"], index)]
 
             pygame.draw.rect(self.surface, background_color, frame_rect, 0, 10)
             pygame.draw.rect(self.surface, (0, 0, 0), frame_rect, 1, 10)
+            self.mark_dirty(frame_rect)
 
             self.draw_text(data["names"][index], frame_rect.centerx, frame_rect.y + 15)
 
@@ -239,7 +244,7 @@ class RockPaperScissorsVisualizer(Visualizer):
 
         self.draw_text(data["message"], center_x, 350)
 
-        pygame.display.flip()
+        self.flush()
 
         delay = 0
         if keyframe:
@@ -248,9 +253,54 @@ class RockPaperScissorsVisualizer(Visualizer):
         
         return delay
 
+    def get_background_color(self, game_winner: int, round_winner: int, index: int) -> tuple[int, int, int]:
+        if game_winner == -1:
+            if round_winner == -1:
+                return (200, 200, 200)
+            elif round_winner == index:
+                return (200, 255, 200)
+            else:
+                return (255, 200, 200)
+        elif game_winner == index:
+            return (200, 255, 200)
+        else:
+            return (200, 200, 200)
+
+    def visualize_waiting(self, parameters: list[str], center_x: int, center_y: int) -> None:
+        required = int(parameters[0])
+        names = parameters[1:]
+
+        self.draw_text(self.game_name, center_x, center_y - 25)
+        self.draw_text("Waiting to start...", center_x, center_y + 25)
+        self.draw_text("%d/%d players connected" % (len(names), required), center_x, center_y + 50)
+        self.draw_text("[%s]" % ", ".join(names), center_x, center_y + 75)
+
+    def visualize_start_in(self, parameters: list[str], center_x: int, center_y: int) -> None:
+        countdown = int(parameters[0])
+        names = parameters[1:]
+
+        self.draw_text(self.game_name, center_x, center_y - 25)
+        self.draw_text("Starting in %d..." % countdown, center_x, center_y + 25)
+        self.draw_text("[%s]" % ", ".join(names), center_x, center_y + 50)
+
+    def visualize_starting(self, parameters: list[str], center_x: int, center_y: int) -> None:
+        names = parameters
+
+        self.draw_text(self.game_name, center_x, center_y - 25)
+        self.draw_text("Starting", center_x, center_y + 25)
+        self.draw_text("[%s]" % ", ".join(names), center_x, center_y + 50)
+
     def draw_text(self, text: str, center_x: int, center_y: int) -> None:
-        text_render = self.font.render(text, True, (0, 0, 0))
-        text_render_rect = text_render.get_rect()
-        text_render_rect.center = (center_x, center_y)
+        text_render = self.text_cache.get(text)
+        if text_render is None:
+            text_render = self.font.render(text, True, (0, 0, 0))
+            self.text_cache[text] = text_render
+            if len(self.text_cache) > self.text_cache_size:
+                self.text_cache.popitem(last=False)
+        else:
+            self.text_cache.move_to_end(text)
+
+        text_render_rect = text_render.get_rect(center=(center_x, center_y))
+        self.mark_dirty(text_render_rect)
 
         self.surface.blit(text_render, text_render_rect)
\ No newline at end of file
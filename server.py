@@ -1,78 +1,87 @@
 import asyncio
 import collections
 import logging
-from pprint import pprint
-from typing import AsyncGenerator, Callable
+from typing import AsyncGenerator, Awaitable, Callable
 import streams_util
 from dataclasses import dataclass, field
 import re
 
-@dataclass
+NAME_PATTERN = re.compile("[^a-zA-Z0-9]+")
+PING_INTERVAL = 2
+SERVER_BACKLOG = 1024
+HTTP_HEADER_TIMEOUT = 0.1
+HTTP_OK = b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n\r\n<html><body><h1>Hello World</h1></body></html>"
+
+@dataclass(slots=True)
 class Connection:
     addr: tuple
     name: str
     type: str
-    reader: asyncio.StreamReader
+    reader: streams_util.LineProtocol
     writer: asyncio.StreamWriter
-    buffer: collections.deque[str] = field(default_factory=collections.deque)
     attributes: dict = field(default_factory=dict)
+    send: Callable[[str], Awaitable[bool]] | None = None
+    ask: Callable[[str], Awaitable[bool]] | None = None
 
     def is_closed(self) -> bool:
         return self.writer.is_closing()
 
     def increment_attribute(self, attribute: str, amount: int = 1) -> None:
-        if attribute not in self.attributes:
-            self.attributes[attribute] = 0
-
-        self.attributes[attribute] += 1
+        self.attributes[attribute] = self.attributes.get(attribute, 0) + amount
 
 class Server:
     def __init__(self) -> None:
-        self.connections: list[Connection] = []
-        self.names: dict[str, Connection] = {}
+        self.connections: dict[str, Connection] = {}
+        self.socket_connections: list[Connection] = []
+        self.socket_writers: list[asyncio.StreamWriter] = []
         self.old_attributes: dict[str, dict] = {}
         self.server: asyncio.base_events.Server = None
         self.connection_queue: collections.deque[Connection] = collections.deque()
         self.disconnection_queue: collections.deque[Connection] = collections.deque()
+        self.connection_event = asyncio.Event()
 
-    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    async def handle_connection(self, reader: streams_util.LineProtocol, writer: asyncio.StreamWriter) -> None:
         addr = writer.get_extra_info("peername")
         name = "%s:%d" % (addr[0], addr[1])
 
-        logging.info("SERVER connected to %s" % name)
-        connection = Connection(addr, name, "", reader, writer)
+        logging.info("SERVER connected to %s", name)
+
+        message = await streams_util.readline(name, reader)
+        if message is not None and message.startswith("GET /"):
+            await self.handle_browser_connection(name, reader, writer, message)
+            return
 
-        message = await self.read_message(connection)
+        connection = Connection(addr, name, "SOCKET" if message == "HELLO" else "", reader, writer)
+        self.create_senders(connection)
+
+        message = await self.check_message(connection, message)
         if message is None:
             logging.info("SERVER connection closed while getting initial message")
             return
             
-        elif message.startswith("GET /"):
-            connection.type = "BROWSER"
-            await self.handle_browser_connection(connection, message)
-            return
-            
         elif message == "HELLO":
-            connection.type = "SOCKET"
             await self.handle_hello_connection(connection)
             return
 
         else:
-            logging.error("SERVER connection provided unexpected message: %s" % message)
+            logging.error("SERVER connection provided unexpected message: %s", message)
             return
             
-    async def handle_browser_connection(self, connection: Connection, data: str) -> None:
-        request = [data]
-        while True:
-            data = await self.read_message(connection)
-            if not data:
-                break
-            request.append(data)
-        
-        pprint(request)
-        
-        await self.send_message(connection, """HTTP/1.0 200 OK\n\n<html><body><h1>Hello World</h1></body></html>""")
-        connection.writer.close()
+    async def handle_browser_connection(self, name: str, reader: streams_util.LineProtocol, writer: asyncio.StreamWriter, data: str) -> None:
+        logging.info("SERVER browser request from %s: %s", name, data)
+
+        try:
+            await asyncio.wait_for(self.drain_headers(name, reader), HTTP_HEADER_TIMEOUT)
+        except TimeoutError:
+            logging.info("SERVER timed out reading request headers from %s", name)
+
+        if not writer.is_closing():
+            writer.write(HTTP_OK)
+        writer.close()
+
+    async def drain_headers(self, name: str, reader: streams_util.LineProtocol) -> None:
+        while await streams_util.readline(name, reader, log_debug=True):
+            pass
 
     async def handle_hello_connection(self, connection: Connection):
         while True:
@@ -82,7 +91,7 @@ class Server:
                 return
 
             name = name.strip()
-            name = re.sub("[^a-zA-Z0-9]+", "_", name)
+            name = NAME_PATTERN.sub("_", name)
 
             if name == "" or name == "_":
                 await self.send_message(connection, "Sorry, you must have letters or numbers in your name")
@@ -103,48 +112,46 @@ class Server:
             connection.name = name
 
             if name in self.old_attributes:
-                logging.debug("SERVER %s has previously played, setting existing attributes" % name)
+                logging.debug("SERVER %s has previously played, setting existing attributes", name)
                 connection.attributes = self.old_attributes[name]
 
             break
 
-        self.connections.append(connection)
-        self.names[connection.name] = connection
+        self.connections[connection.name] = connection
+        self.update_socket_writers()
         self.connection_queue.append(connection)
-
-        asyncio.create_task(self.ping_connection(connection))
+        self.connection_event.set()
 
     def name_exists(self, name: str) -> bool:
-        return name in self.names
+        return name in self.connections
+
+    def update_socket_writers(self) -> None:
+        self.socket_connections = list(self.connections.values())
+        self.socket_writers = [connection.writer for connection in self.socket_connections]
 
-    async def ping_connection(self, connection: Connection) -> None:
+    async def ping_loop(self) -> None:
         while True:
-            if connection.is_closed():
-                logging.info("SERVER ping (%s) cancelled - connection is already closed" % connection.name)
-                return
-            
-            success = await streams_util.writeline(connection.name, connection.writer, "PING", log_debug=True)
-            if not success:
-                logging.info("SERVER ping (%s) was not successful" % connection.name)
-                await self.close_connection(connection)
-                return
-            
-            await asyncio.sleep(2)
+            await asyncio.sleep(PING_INTERVAL)
+
+            for connection in self.socket_connections:
+                if connection.is_closed():
+                    logging.info("SERVER ping (%s) found the connection closed", connection.name)
+                    await self.close_connection(connection)
+
+            logging.debug("SERVER ping %d connections", len(self.socket_writers))
+            await self.write_payload(streams_util.PING_FRAME)
 
     async def close_connection(self, connection: Connection) -> None:
         if not connection.is_closed():
             logging.info("SERVER sending connection close message")
-            await self.send_message(connection, "quit")
+            quit_frame = streams_util.SOCKET_QUIT_FRAME if connection.type == "SOCKET" else streams_util.QUIT_FRAME
+            await streams_util.writeline(connection.name, connection.writer, quit_frame)
         
-        if connection in self.connections:
-            self.connections.remove(connection)
+        if self.connections.get(connection.name) is connection:
+            del self.connections[connection.name]
+            self.update_socket_writers()
         else:
             logging.warning("SERVER connection not in server connections")
-
-        if connection.name in self.names:
-            del self.names[connection.name]
-        else:
-            logging.warning("SERVER connection name not in server names")
         
         connection.writer.close()
 
@@ -152,6 +159,7 @@ class Server:
             self.old_attributes[connection.name] = connection.attributes
 
         self.disconnection_queue.append(connection)
+        self.connection_event.set()
 
     def prefix_message(self, message: str, expected_response: bool) -> str:
         if message.startswith("Y: ") or message.startswith("N: "):
@@ -162,46 +170,94 @@ class Server:
         else:
             return "N: " + message
 
-    async def send_message(self, connection: Connection, message: str) -> None:
+    def create_senders(self, connection: Connection) -> None:
         if connection.type == "SOCKET":
-            message = self.prefix_message(message, False)
+            connection.send = self.create_sender(connection, "N: ")
+            connection.ask = self.create_sender(connection, "Y: ")
+        else:
+            connection.send = connection.ask = self.create_sender(connection, "")
 
-        success = await streams_util.writeline(connection.name, connection.writer, message)
+    def create_sender(self, connection: Connection, prefix: str) -> Callable[[str], Awaitable[bool]]:
+        writer = connection.writer
+
+        if prefix:
+            async def send(message: str) -> bool:
+                return await streams_util.writeline(connection.name, writer, prefix + message)
+        else:
+            async def send(message: str) -> bool:
+                return await streams_util.writeline(connection.name, writer, message)
+
+        return send
+
+    async def send_message(self, connection: Connection, message: str) -> None:
+        success = await connection.send(message)
         if not success:
-            logging.info("SERVER write to %s was not successful" % connection.name)
+            logging.info("SERVER write to %s was not successful", connection.name)
             await self.close_connection(connection)
 
     async def read_message(self, connection: Connection) -> str:
-        response = await streams_util.readline(connection.name, connection.reader, connection.buffer)
+        response = await streams_util.readline(connection.name, connection.reader)
+        return await self.check_message(connection, response)
 
+    async def check_message(self, connection: Connection, response: str) -> str:
         if response is None:
-            logging.info("SERVER no message from %s" % connection.name)
+            logging.info("SERVER no message from %s", connection.name)
             await self.close_connection(connection)
             return None
         
         if response == "quit":
-            logging.info("SERVER quit command recieved from %s" % connection.name)
+            logging.info("SERVER quit command recieved from %s", connection.name)
             await self.close_connection(connection)
             return None
 
         return response
 
     async def get_response(self, connection: Connection, prompt: str) -> str:
-        if connection.type == "SOCKET":
-            prompt = self.prefix_message(prompt, True)
-        
-        await self.send_message(connection, prompt)
+        success = await connection.ask(prompt)
+        if not success:
+            logging.info("SERVER write to %s was not successful", connection.name)
+            await self.close_connection(connection)
         
         response = await self.read_message(connection)
         return response
 
-    # async def announce_message(self, message: str, connections: list[Connection] = None) -> None:
-    #     if connections is None:
-    #         connections = self.connections
+    async def broadcast(self, message: str, connections: list[Connection] = None) -> None:
+        count = len(self.socket_writers) if connections is None else len(connections)
+        logging.info("SERVER broadcast to %d connections: %s", count, message)
+        payload = (self.prefix_message(message, False) + "\n").encode()
+        await self.write_payload(payload, connections)
 
-    #     await asyncio.gather(
-    #         *[self.send_message(conn, message) for conn in connections]
-    #     )
+    async def write_payload(self, payload: bytes, connections: list[Connection] = None) -> None:
+        if connections is None:
+            connections = self.socket_connections
+            writers = self.socket_writers
+        else:
+            writers = [connection.writer for connection in connections]
+
+        draining: list[int] = []
+        for index, writer in enumerate(writers):
+            if writer.is_closing():
+                continue
+
+            writer.write(payload)
+
+            transport = writer.transport
+            if transport.get_write_buffer_size() >= transport.get_write_buffer_limits()[1]:
+                draining.append(index)
+
+        if not draining:
+            return
+
+        results = await asyncio.gather(
+            *[writers[index].drain() for index in draining],
+            return_exceptions=True
+        )
+
+        for index, result in zip(draining, results):
+            if isinstance(result, Exception):
+                connection = connections[index]
+                logging.info("SERVER write to %s was not successful", connection.name)
+                await self.close_connection(connection)
 
     # async def get_responses(self, prompt: str, connections: list[Connection] = None):# -> AsyncGenerator[tuple[str, int, Connection], None, None]:
     #     if connections is None:
@@ -238,7 +294,7 @@ class Server:
     async def stop_server(self) -> None:
         logging.debug("SERVER: closing connections")
         await asyncio.gather(
-            *[self.close_connection(conn) for conn in self.connections]
+            *[self.close_connection(conn) for conn in list(self.connections.values())]
         )
         logging.debug("SERVER: connections closed")
 
@@ -248,7 +304,13 @@ class Server:
 
     async def start_server(self) -> None:
         try:
-            self.server = await asyncio.start_server(self.handle_connection, "192.168.99.108", 12345)
+            loop = asyncio.get_running_loop()
+            self.server = await loop.create_server(
+                lambda: streams_util.LineProtocol(self.handle_connection),
+                "192.168.99.108",
+                12345,
+                backlog=SERVER_BACKLOG
+            )
         except TimeoutError as ex:
             logging.error("SERVER ERROR start server timeout", exc_info=ex)
             return
@@ -260,10 +322,14 @@ class Server:
             return
 
         addr = self.server.sockets[0].getsockname() if self.server.sockets else "unknown"
-        logging.info("SERVER serving on %s" % (addr,))
+        logging.info("SERVER serving on %s", addr)
+
+        ping_task = asyncio.create_task(self.ping_loop())
 
         async with self.server:
             try:
                 await self.server.serve_forever()
             except asyncio.CancelledError as ex:
-                logging.warning("SERVER ERROR server cancelled", exc_info=ex)
\ No newline at end of file
+                logging.warning("SERVER ERROR server cancelled", exc_info=ex)
+            finally:
+                ping_task.cancel()
\ No newline at end of file
@@ -1,68 +1,203 @@
 import asyncio
 import collections
 import logging
+from typing import Awaitable, Callable
 
-def log(debug: bool, debug_prefix: list[str], name: str, message: str) -> None:
-    debug_message = "%s: %s" % (name, message)
-    if debug or any(message.startswith(p) for p in debug_prefix):
-        logging.debug(debug_message)
-    else:
-        logging.info(debug_message)
+NEWLINE = b"\n"
+PING_FRAME = b"PING\n"
+QUIT_FRAME = b"quit\n"
+SOCKET_QUIT_FRAME = b"N: quit\n"
+READ_BUFFER_SIZE = 65536
+LINE_LIMIT = 2 ** 16
+PENDING_LINE_LIMIT = 1024
 
-async def readline(name: str, reader: asyncio.StreamReader, buffer: collections.deque[str], *, log_debug: bool = False, log_debug_prefix: list[str] = []) -> str:
+# FlowControlMixin and the StreamWriter constructor are not public asyncio API.
+# LineProtocol mirrors StreamReaderProtocol's use of them, checked against Python 3.11 - 3.13.
+class LineProtocol(asyncio.streams.FlowControlMixin, asyncio.BufferedProtocol):
+    buffer_pool: collections.deque[bytearray] = collections.deque()
+
+    def __init__(self, client_connected: Callable[["LineProtocol", asyncio.StreamWriter], Awaitable[None]] = None) -> None:
+        super().__init__(asyncio.get_running_loop())
+        self.client_connected = client_connected
+        self.client_task: asyncio.Task = None
+        self.transport: asyncio.Transport = None
+        self.writer: asyncio.StreamWriter = None
+        self.buffer: bytearray = None
+        self.partial = bytearray()
+        self.lines: collections.deque[str] = collections.deque()
+        self.reading_paused = False
+        self.line_waiter: asyncio.Future = None
+        self.eof = False
+        self.exception: Exception = None
+        self.closed: asyncio.Future = self._loop.create_future()
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.writer = asyncio.StreamWriter(transport, self, None, self._loop)
+        if self.client_connected is not None:
+            self.client_task = self._loop.create_task(self.client_connected(self, self.writer))
+
+    def get_buffer(self, sizehint: int) -> bytearray:
+        if self.buffer is None:
+            self.buffer = self.buffer_pool.pop() if self.buffer_pool else bytearray(READ_BUFFER_SIZE)
+
+        return self.buffer
+
+    def release_buffer(self) -> None:
+        if self.buffer is not None:
+            self.buffer_pool.append(self.buffer)
+            self.buffer = None
+
+    def buffer_updated(self, nbytes: int) -> None:
+        buffer = self.buffer
+        self.buffer = None
+
+        with memoryview(buffer) as view:
+            start = 0
+            while (end := buffer.find(NEWLINE, start, nbytes)) >= 0:
+                if self.partial:
+                    self.partial += view[start:end]
+                    line = decode_line(self.partial)
+                    self.partial.clear()
+                else:
+                    line = decode_line(view[start:end])
+
+                self.lines.append(line)
+                start = end + 1
+
+            self.partial += view[start:nbytes]
+
+        self.buffer_pool.append(buffer)
+
+        if len(self.partial) > LINE_LIMIT:
+            self.exception = ValueError("Line is longer than %d bytes" % LINE_LIMIT)
+
+        if (self.exception is not None or len(self.lines) > PENDING_LINE_LIMIT) and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+        self.wake_reader()
+
+    def eof_received(self) -> bool:
+        self.release_buffer()
+        self.eof = True
+        self.wake_reader()
+        return True
+
+    def connection_lost(self, exc: Exception) -> None:
+        super().connection_lost(exc)
+        self.release_buffer()
+        if exc is None:
+            self.eof = True
+        else:
+            self.exception = exc
+        self.wake_reader()
+
+        if not self.closed.done():
+            if exc is None:
+                self.closed.set_result(None)
+            else:
+                self.closed.set_exception(exc)
+                self.closed.exception()
+
+    def _get_close_waiter(self, stream: asyncio.StreamWriter) -> asyncio.Future:
+        return self.closed
+
+    def wake_reader(self) -> None:
+        if self.line_waiter is not None and not self.line_waiter.done():
+            self.line_waiter.set_result(None)
+
+    async def readline(self) -> str:
+        while not self.lines:
+            if self.exception is not None:
+                raise self.exception
+
+            if self.eof:
+                if not self.partial:
+                    return None
+
+                line = decode_line(self.partial)
+                self.partial.clear()
+                return line
+
+            self.line_waiter = self._loop.create_future()
+            try:
+                await self.line_waiter
+            finally:
+                self.line_waiter = None
+
+        line = self.lines.popleft()
+
+        if self.reading_paused and self.exception is None and len(self.lines) <= PENDING_LINE_LIMIT // 2:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+        return line
+
+def decode_line(data: bytes) -> str:
+    if data[-1:] == b"\r":
+        data = data[:-1]
+
+    return str(data, "utf-8", "replace")
+
+async def open_connection(host: str, port: int) -> tuple[LineProtocol, asyncio.StreamWriter]:
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_connection(LineProtocol, host, port)
+    return protocol, protocol.writer
+
+def log(debug: bool, debug_prefix: list[str], action: str, name: str, message: str | bytes) -> None:
+    level = logging.INFO
+    if debug or (isinstance(message, str) and any(message.startswith(p) for p in debug_prefix)):
+        level = logging.DEBUG
+
+    if not logging.getLogger().isEnabledFor(level):
+        return
+
+    if isinstance(message, bytes):
+        message = message.decode().removesuffix("\n")
+
+    logging.log(level, "%s (%s): %s", action, name, message)
+
+async def readline(name: str, reader: LineProtocol, *, log_debug: bool = False, log_debug_prefix: list[str] = []) -> str:
     try:
-        message = ""
-        while buffer:
-            message += buffer.popleft()
-            for eol in ["\r\n", "\n"]:
-                if eol in message:
-                    message, extra = message.split(eol, 1)
-                    if extra:
-                        buffer.appendleft(extra)
-
-                    log(log_debug, log_debug_prefix, "READ (%s)" % name, message)
-                    return message
-
-        data = message.encode()
-        while data := data + await reader.read(100):
-            message = data.decode()
-            for eol in ["\r\n", "\n"]:
-                if eol in message:
-                    message, extra = message.split(eol, 1)
-                    if extra:
-                        buffer.append(extra)
-
-                    log(log_debug, log_debug_prefix, "READ (%s)" % name, message)
-                    return message
+        message = await reader.readline()
 
     except ConnectionResetError as ex:
-        logging.error("STREAMS READ ERROR (%s) - connection reset error" % name, exc_info=ex)
-        pass
+        logging.error("STREAMS READ ERROR (%s) - connection reset error", name, exc_info=ex)
+        return None
 
-    if data:
-        message = data.decode()
-        log(log_debug, log_debug_prefix, "READ (%s)" % name, message)
-        return message
+    except ValueError as ex:
+        logging.error("STREAMS READ ERROR (%s) - line is too long", name, exc_info=ex)
+        return None
 
-async def writeline(name: str, writer: asyncio.StreamWriter, message: str, *, log_debug: bool = False, log_debug_prefix: list[str] = []) -> bool:
-    try:
-        log(log_debug, log_debug_prefix, "WRITE (%s)" % name, message)
+    if message is None:
+        return None
 
-        if not message.endswith("\n"):
-            message += "\n"
+    log(log_debug, log_debug_prefix, "READ", name, message)
+    return message
+
+async def writeline(name: str, writer: asyncio.StreamWriter, message: str | bytes, *, log_debug: bool = False, log_debug_prefix: list[str] = []) -> bool:
+    try:
+        log(log_debug, log_debug_prefix, "WRITE", name, message)
+        payload = message if isinstance(message, bytes) else message.encode()
 
         if writer.is_closing():
-            logging.error("STREAMS WRITE ERROR (%s) - writer is closing" % name)
+            logging.error("STREAMS WRITE ERROR (%s) - writer is closing", name)
             return False
 
-        writer.write(message.encode())
-        await writer.drain()
+        if not payload.endswith(NEWLINE):
+            payload += NEWLINE
+
+        writer.write(payload)
+
+        if writer.transport.get_write_buffer_size() > 0:
+            await writer.drain()
         return True
 
     except ConnectionResetError as ex:
-        logging.error("STREAMS WRITE ERROR (%s) - connection reset error" % name, exc_info=ex)
+        logging.error("STREAMS WRITE ERROR (%s) - connection reset error", name, exc_info=ex)
         return False
 
     except BrokenPipeError as ex:
-        logging.error("STREAMS WRITE ERROR (%s) - broken pipe error" % name, exc_info=ex)
+        logging.error("STREAMS WRITE ERROR (%s) - broken pipe error", name, exc_info=ex)
         return False
\ No newline at end of file
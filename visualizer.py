@@ -1,3 +1,4 @@
+import asyncio
 import pygame
 import logging
 
@@ -7,7 +8,12 @@ class Visualizer:
         pygame.init()
         pygame.display.set_caption(game_name)
         self.surface = pygame.display.set_mode((600, 400))
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(self.get_allowed_events())
         self.clock = pygame.time.Clock()
+        self.frame_ticks = pygame.time.get_ticks()
+        self.dirty_rects: list[pygame.Rect] = []
+        self.previous_dirty_rects: list[pygame.Rect] = [self.surface.get_rect()]
         self.running = True
         self.game_name = game_name
 
@@ -17,21 +23,45 @@ class Visualizer:
     async def visualize(self, data: str, keyframe: bool) -> int:
         raise NotImplementedError("visualize needs to be implemented")
 
-    async def process_events(self) -> None:
+    def process_events(self) -> None:
         py_events = pygame.event.get()
         for event in py_events:
             if event.type == pygame.QUIT:
                 logging.debug("GAME VISUALIZER: quit event")
                 self.running = False
 
-            await self.handle_event(event)
+            self.handle_event(event)
 
         if not self.running:
             logging.info("GAME VISUALIZER: quit pygame")
             pygame.quit()
 
-    async def handle_event(self, event: pygame.event.Event) -> None:
+    def handle_event(self, event: pygame.event.Event) -> None:
         pass
 
+    async def wait_next_frame(self) -> int:
+        frame_time = 1000 / self.get_fps()
+        elapsed = pygame.time.get_ticks() - self.frame_ticks
+        if elapsed < frame_time:
+            await asyncio.sleep((frame_time - elapsed) / 1000)
+
+        dt = self.clock.tick()
+        self.frame_ticks = pygame.time.get_ticks()
+        return dt
+
+    def mark_dirty(self, rect: pygame.Rect) -> None:
+        self.dirty_rects.append(rect)
+
+    def flush(self) -> None:
+        # Regions drawn last frame are updated too, so anything cleared since then is erased on screen
+        if self.dirty_rects or self.previous_dirty_rects:
+            pygame.display.update(self.previous_dirty_rects + self.dirty_rects)
+
+        self.previous_dirty_rects = self.dirty_rects
+        self.dirty_rects = []
+
+    def get_allowed_events(self) -> list[int]:
+        return [pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP, pygame.MOUSEBUTTONDOWN]
+
     def get_fps(self) -> int:
         return 30
\ No newline at end of file